@@ -0,0 +1,279 @@
+# bulk.py
+
+# Streaming NDJSON import/export of communities, posts and votes.
+# Every line is one JSON object tagged with its "kind" (not "type", communities have
+# a type of their own):
+#
+#   {"kind": "community", "id": 1, "name": "python", "type": "private", "owner_user_id": 1, ...}
+#   {"kind": "post", "id": 10, "community_id": 1, "author_user_id": 1, "title": "..."}
+#   {"kind": "vote", "post_id": 10, "user_id": 2, "value": 1}
+#
+# Parents must come before their children (export writes them in that order).
+# Rows are written with multi-row INSERTs, one commit per batch, and the number of
+# the last committed line is the checkpoint to resume from.
+#
+# A line whose key (id, community name, post+user of a vote) already exists is
+# skipped when the stored row is the same one (replaying lines that were committed
+# after the last checkpoint the client saw) and stops the import otherwise, so
+# imported children never attach to an unrelated local row. Give posts explicit
+# ids if the import has to be safely re-runnable.
+#
+#   python bulk.py import dump.ndjson --batch-size 1000 --checkpoint dump.ckpt
+#   python bulk.py export dump.ndjson --kinds community,post,vote
+
+# ---------- IMPORTS ----------
+
+from typing import AsyncIterable, Callable, Dict, Iterable, Iterator, List, Optional
+import argparse
+import json
+import os
+import sys
+
+from pydantic import ValidationError
+from sqlmodel import Session, select
+from sqlalchemy import insert, or_, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import Community, Post, PostVote
+from schemas import CommunityRecord, PostRecord, VoteRecord
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_EXPORT_CHUNK = int(os.getenv("BULK_EXPORT_CHUNK", "1000")) # rows fetched per round trip on export
+
+# In insert (and export) order, parents first
+KINDS = ("community", "post", "vote")
+MODELS = {"community": Community, "post": Post, "vote": PostVote}
+RECORDS = {"community": CommunityRecord, "post": PostRecord, "vote": VoteRecord}
+TAG = "kind" # key of the line's kind, none of the records has a field by that name
+
+class BulkImportError(ValueError):
+    def __init__(self, line: int, checkpoint: int, error: str):
+        super().__init__("line {}: {}".format(line, error))
+        self.line = line
+        self.checkpoint = checkpoint
+        self.error = error
+
+# ---------- LINES ----------
+
+async def aiter_lines(chunks: AsyncIterable[bytes]):
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+# ---------- IMPORT ----------
+
+# Fields that must match for an existing row to count as the same line replayed
+IDENTITY = {
+    "community": ("id", "name", "owner_user_id"),
+    "post": ("id", "community_id", "author_user_id", "title"),
+    "vote": ("post_id", "user_id", "value"),
+}
+
+class _Conflict(ValueError):
+    pass
+
+def _existing(session: Session, kind: str, rows: List[dict]) -> List:
+    # One query per kind and batch for the rows that could collide
+    if kind == "community":
+        ids = [r["id"] for r in rows if r["id"] is not None]
+        names = [r["name"] for r in rows]
+        return session.exec(select(Community).where(or_(Community.id.in_(ids), Community.name.in_(names)))).all()
+    if kind == "post":
+        ids = [r["id"] for r in rows if r["id"] is not None]
+        return session.exec(select(Post).where(Post.id.in_(ids))).all() if ids else []
+    pairs = [(r["post_id"], r["user_id"]) for r in rows]
+    return session.exec(select(PostVote).where(tuple_(PostVote.post_id, PostVote.user_id).in_(pairs))).all()
+
+def _keys(kind: str, row: dict) -> List:
+    if kind == "community":
+        return [("id", row["id"]), ("name", row["name"])]
+    if kind == "post":
+        return [("id", row["id"])]
+    return [("vote", row["post_id"], row["user_id"])]
+
+def _new_rows(session: Session, kind: str, rows: List[dict]) -> List[dict]:
+    """Drop rows already stored identically, raise _Conflict on a different one."""
+    stored: Dict[tuple, dict] = {}
+    for obj in _existing(session, kind, rows):
+        data = {field: getattr(obj, field) for field in IDENTITY[kind]}
+        for key in _keys(kind, data):
+            stored[key] = data
+
+    new_rows = []
+    for row in rows:
+        match = next((stored[k] for k in _keys(kind, row) if k[-1] is not None and k in stored), None)
+        if match is None:
+            new_rows.append(row)
+            continue
+        fields = [f for f in IDENTITY[kind] if not (f == "id" and row["id"] is None)]
+        if any(row[f] != match[f] for f in fields):
+            raise _Conflict("{} {} conflicts with an existing row".format(
+                kind, {f: row[f] for f in IDENTITY[kind]},
+            ))
+    return new_rows
+
+class Importer:
+    """Feed it lines one by one, flush when `feed` says the batch is full.
+
+    Parsing is kept apart from flushing so the async endpoint can read the request
+    body on the event loop and only hop to a thread for the inserts.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        batch_size: int = BULK_BATCH_SIZE,
+        resume_from: int = 0,
+        on_checkpoint: Optional[Callable[[int], None]] = None,
+    ):
+        self.session = session
+        self.batch_size = batch_size
+        self.resume_from = resume_from
+        self.on_checkpoint = on_checkpoint
+
+        self.line = 0
+        self.checkpoint = resume_from
+        self.pending: Dict[str, List[dict]] = {kind: [] for kind in KINDS}
+        self.pending_count = 0
+        self.written: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self.skipped: Dict[str, int] = {kind: 0 for kind in KINDS}
+
+    def feed(self, raw) -> bool:
+        """Parse one line, returns True when a flush is due."""
+        self.line += 1
+        if self.line <= self.resume_from:
+            return False
+
+        raw = raw.strip()
+        if not raw:
+            return False
+
+        try:
+            data = json.loads(raw)
+            kind = data.pop(TAG)
+            record = RECORDS[kind].model_validate(data)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # ValidationError and JSONDecodeError are ValueErrors
+            message = e.errors(include_url=False) if isinstance(e, ValidationError) else str(e) or type(e).__name__
+            raise BulkImportError(self.line, self.checkpoint, str(message))
+
+        self.pending[kind].append(record.model_dump())
+        self.pending_count += 1
+        return self.pending_count >= self.batch_size
+
+    def flush(self) -> None:
+        if self.pending_count:
+            written: Dict[str, int] = {}
+            try:
+                for kind in KINDS:
+                    rows = self.pending[kind]
+                    if rows:
+                        rows = _new_rows(self.session, kind, rows)
+                        if rows:
+                            self.session.execute(insert(MODELS[kind]), rows)
+                    written[kind] = len(rows)
+                self.session.commit()
+            except _Conflict as e:
+                self.session.rollback()
+                raise BulkImportError(self.line, self.checkpoint, str(e))
+            except SQLAlchemyError as e:
+                self.session.rollback()
+                raise BulkImportError(self.line, self.checkpoint, str(e.orig if hasattr(e, "orig") else e))
+
+            for kind in KINDS:
+                self.written[kind] += written[kind]
+                self.skipped[kind] += len(self.pending[kind]) - written[kind]
+                self.pending[kind] = []
+            self.pending_count = 0
+
+        if self.line > self.checkpoint:
+            self.checkpoint = self.line
+            if self.on_checkpoint:
+                self.on_checkpoint(self.checkpoint)
+
+    def result(self) -> dict:
+        return {"lines": self.line, "checkpoint": self.checkpoint, "written": self.written, "skipped": self.skipped}
+
+# ---------- EXPORT ----------
+
+def export_ndjson(engine, kinds: Iterable[str] = KINDS) -> Iterator[str]:
+    # yield_per streams through a server-side cursor, so memory stays flat
+    with Session(engine) as session:
+        for kind in kinds:
+            model = MODELS[kind]
+            record = RECORDS[kind]
+            order = (model.post_id, model.user_id) if kind == "vote" else (model.id,)
+            stmt = select(model).order_by(*order).execution_options(yield_per=BULK_EXPORT_CHUNK)
+            for row in session.exec(stmt):
+                data = record.model_validate(row, from_attributes=True).model_dump(mode="json")
+                yield json.dumps({TAG: kind, **data}) + "\n"
+
+def parse_kinds(kinds: Optional[str]) -> List[str]:
+    if not kinds:
+        return list(KINDS)
+    wanted = [k.strip() for k in kinds.split(",") if k.strip()]
+    unknown = [k for k in wanted if k not in MODELS]
+    if unknown:
+        raise ValueError("unknown kinds: {}".format(", ".join(unknown)))
+    # Keep parents first whatever order they were asked in
+    return [k for k in KINDS if k in wanted]
+
+# ---------- CLI ----------
+
+def _read_checkpoint(path: Optional[str]) -> int:
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+def _write_checkpoint(path: str, line: int) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(str(line))
+    os.replace(tmp, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carisma NDJSON bulk import/export")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    import_p = sub.add_parser("import", help="import an NDJSON file ('-' for stdin)")
+    import_p.add_argument("file")
+    import_p.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    import_p.add_argument("--checkpoint", default=None, help="file to resume from and record progress in")
+
+    export_p = sub.add_parser("export", help="export to an NDJSON file ('-' for stdout)")
+    export_p.add_argument("file")
+    export_p.add_argument("--kinds", default=None, help="comma separated, default: " + ",".join(KINDS))
+
+    args = parser.parse_args()
+
+    import main
+
+    if args.command == "import":
+        source = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+        with source, Session(main.get_engine()) as session:
+            importer = Importer(
+                session,
+                batch_size=args.batch_size,
+                resume_from=_read_checkpoint(args.checkpoint),
+                on_checkpoint=(lambda line: _write_checkpoint(args.checkpoint, line)) if args.checkpoint else None,
+            )
+            try:
+                for line in source:
+                    if importer.feed(line):
+                        importer.flush()
+                importer.flush()
+            except BulkImportError as e:
+                sys.exit("import stopped at {} (checkpoint {})".format(e, e.checkpoint))
+        print(json.dumps(importer.result()))
+
+    elif args.command == "export":
+        target = sys.stdout if args.file == "-" else open(args.file, "w")
+        with target:
+            for line in export_ndjson(main.get_engine(), parse_kinds(args.kinds)):
+                target.write(line)
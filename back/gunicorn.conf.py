@@ -0,0 +1,61 @@
+# gunicorn.conf.py
+
+# Production entry point, picked up automatically by:
+#
+#   gunicorn main:app
+#
+# N uvicorn workers (one per core by default) forked from a master that has the app
+# already imported (preload_app), so workers start fast and share the imported code.
+# Nothing that opens sockets may run at import time: the engine, the realtime hub,
+# the thumbnail pool and the job worker thread are all created in the lifespan,
+# i.e. in each worker after the fork.
+#
+#   kill -TERM <master>   graceful stop: workers finish in-flight requests (graceful_timeout)
+#   kill -USR2 <master>   start a new master with the new code, then
+#   kill -TERM <old>      drain the old one. (HUP only restarts workers and, because the
+#                         app is preloaded, keeps serving the old code.)
+#
+# /ready answers 503 until a worker has finished its startup, so the load balancer only
+# sends traffic to workers that have a DB pool. Once a worker is told to stop it closes
+# its listening socket; in-flight requests then have graceful_timeout to finish.
+#
+# With more than one worker set REALTIME_BACKEND_URL: realtime events, permission
+# changes and the vote cache are per process without it.
+
+import multiprocessing
+import os
+
+# Set before the app is imported by the master
+os.environ.setdefault("DB_ECHO", "0")
+os.environ.setdefault("DB_CREATE_ALL", "0")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Recycle workers now and then so a slow leak never takes a worker down under load
+max_requests = int(os.getenv("MAX_REQUESTS", "10000"))
+max_requests_jitter = max_requests // 10
+
+def on_starting(server):
+    if server.cfg.workers > 1 and not os.getenv("REALTIME_BACKEND_URL"):
+        server.log.warning(
+            "%s workers without REALTIME_BACKEND_URL: realtime events only reach clients of "
+            "the same worker and role changes reach the others only on their next reload. "
+            "Set REALTIME_BACKEND_URL=redis://... or WEB_CONCURRENCY=1.",
+            server.cfg.workers,
+        )
+
+    # Tables once in the master, instead of every worker racing on the same DDL
+    import main
+    main.create_tables()
+
+def post_fork(server, worker):
+    # In case anything touched the engine in the master, never reuse its connections
+    import main
+    main.dispose_engine()
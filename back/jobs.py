@@ -0,0 +1,346 @@
+# jobs.py
+
+# Durable job queue on top of the `jobs` table, so no external broker is needed.
+# Endpoints call `enqueue(...)` before their own commit (the job only exists if the
+# request's transaction does) and return; a worker claims batches and runs them.
+#
+#   python jobs.py worker              # long running worker
+#   python jobs.py worker --once       # drain what is due and exit
+#   python jobs.py stats
+#   python jobs.py retry-failed [--kind KIND]
+#
+# Or set JOBS_IN_PROCESS=1 to run a worker thread inside the API process.
+
+# ---------- IMPORTS ----------
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+from dataclasses import dataclass
+import argparse
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from sqlmodel import Session, select
+from sqlalchemy import func, insert, update, delete
+
+from models import Job, JobStatus
+
+JOBS_BATCH_SIZE = int(os.getenv("JOBS_BATCH_SIZE", "20"))
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "1.0")) # seconds between polls when idle
+JOBS_BACKOFF_BASE = float(os.getenv("JOBS_BACKOFF_BASE", "2.0")) # seconds, doubled on every attempt
+JOBS_BACKOFF_MAX = float(os.getenv("JOBS_BACKOFF_MAX", "600.0"))
+JOBS_LOCK_TIMEOUT = int(os.getenv("JOBS_LOCK_TIMEOUT", "300")) # a job (or batch) running longer than this is considered lost
+JOBS_REQUEUE_INTERVAL = int(os.getenv("JOBS_REQUEUE_INTERVAL", "60")) # seconds between checks for lost jobs
+
+log = logging.getLogger("carisma.jobs")
+
+# ---------- REGISTRY ----------
+
+@dataclass
+class _Handler:
+    fn: Callable
+    batch: bool
+
+_handlers: Dict[str, _Handler] = {}
+
+def job(kind: str, batch: bool = False):
+    """Register a handler for `kind`.
+
+    Normal handlers are called as `fn(session, payload)` once per job. With
+    `batch=True` they are called as `fn(session, payloads)` with every claimed job
+    of that kind, so work like counter reconciliation can be done in one query.
+    The handler must not commit; the worker commits its work together with the
+    removal of the job.
+    """
+    def decorator(fn: Callable) -> Callable:
+        _handlers[kind] = _Handler(fn=fn, batch=batch)
+        return fn
+    return decorator
+
+# ---------- ENQUEUE ----------
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def enqueue(
+    session: Session,
+    kind: str,
+    payload: Optional[dict] = None,
+    priority: int = 0,
+    delay: float = 0,
+    max_attempts: int = 5,
+) -> Job:
+    # No commit here, the job is written with the caller's transaction
+    job_row = Job(
+        kind=kind,
+        payload=payload or {},
+        priority=priority,
+        max_attempts=max_attempts,
+        run_at=_now() + timedelta(seconds=delay),
+    )
+    session.add(job_row)
+    return job_row
+
+def enqueue_many(
+    session: Session,
+    kind: str,
+    payloads: Iterable[dict],
+    priority: int = 0,
+    delay: float = 0,
+    max_attempts: int = 5,
+) -> int:
+    # Multi-row INSERT, for fan-out where one request produces many jobs
+    now = _now()
+    run_at = now + timedelta(seconds=delay)
+    rows = [
+        {
+            "kind": kind,
+            "payload": payload,
+            "priority": priority,
+            "status": JobStatus.QUEUED,
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "run_at": run_at,
+            "created_at": now,
+        }
+        for payload in payloads
+    ]
+    if rows:
+        session.execute(insert(Job), rows)
+    return len(rows)
+
+# ---------- WORKER ----------
+
+def backoff(attempts: int) -> float:
+    # Exponential with jitter, so failing jobs don't retry in lockstep
+    delay = min(JOBS_BACKOFF_MAX, JOBS_BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class Worker:
+    def __init__(
+        self,
+        engine,
+        batch_size: int = JOBS_BATCH_SIZE,
+        poll_interval: float = JOBS_POLL_INTERVAL,
+        kinds: Optional[List[str]] = None,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.kinds = kinds
+        self.worker_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.get_ident())
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- Claiming ----
+
+    def requeue_stale(self) -> int:
+        # Jobs whose worker died mid-run go back to the queue, unless they are out of
+        # attempts: a job that keeps killing its worker must not come back forever
+        stale = _now() - timedelta(seconds=JOBS_LOCK_TIMEOUT)
+        with Session(self.engine) as session:
+            session.execute(
+                update(Job)
+                .where(Job.status == JobStatus.RUNNING, Job.locked_at < stale, Job.attempts >= Job.max_attempts)
+                .values(status=JobStatus.FAILED, locked_by=None, locked_at=None, last_error="worker lost while running the job")
+            )
+            result = session.execute(
+                update(Job)
+                .where(Job.status == JobStatus.RUNNING, Job.locked_at < stale)
+                .values(status=JobStatus.QUEUED, locked_by=None, locked_at=None)
+            )
+            session.commit()
+            return result.rowcount
+
+    def claim(self) -> List[Job]:
+        now = _now()
+        with Session(self.engine, expire_on_commit=False) as session:
+            stmt = (
+                select(Job)
+                .where(Job.status == JobStatus.QUEUED, Job.run_at <= now)
+                .order_by(Job.priority.desc(), Job.run_at, Job.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True) # several workers never claim the same row
+            )
+            if self.kinds:
+                stmt = stmt.where(Job.kind.in_(self.kinds))
+
+            jobs = session.exec(stmt).all()
+            for job_row in jobs:
+                job_row.status = JobStatus.RUNNING
+                job_row.locked_by = self.worker_id
+                job_row.locked_at = now
+                job_row.attempts += 1
+            session.commit()
+            return list(jobs)
+
+    def heartbeat(self, jobs: List[Job]) -> List[Job]:
+        """Renew the lock of claimed jobs right before running them.
+
+        A claimed group runs one job after another, so the lock is taken again per
+        job instead of once for the group. Returns the jobs still held by this worker
+        (the others were requeued as lost meanwhile and belong to someone else now).
+        """
+        ids = [j.id for j in jobs]
+        with Session(self.engine) as session:
+            session.execute(
+                update(Job)
+                .where(Job.id.in_(ids), Job.status == JobStatus.RUNNING, Job.locked_by == self.worker_id)
+                .values(locked_at=_now())
+            )
+            session.commit()
+            held = set(session.exec(
+                select(Job.id).where(Job.id.in_(ids), Job.status == JobStatus.RUNNING, Job.locked_by == self.worker_id)
+            ).all())
+        return [j for j in jobs if j.id in held]
+
+    # ---- Running ----
+
+    def _done(self, session: Session, jobs: List[Job]) -> None:
+        session.execute(delete(Job).where(Job.id.in_([j.id for j in jobs])))
+
+    def _failed(self, jobs: List[Job], error: str) -> None:
+        with Session(self.engine) as session:
+            for job_row in jobs:
+                values = {"locked_by": None, "locked_at": None, "last_error": error[-255:]}
+                if job_row.attempts >= job_row.max_attempts:
+                    values["status"] = JobStatus.FAILED
+                    log.error("job %s (%s) failed permanently: %s", job_row.id, job_row.kind, error)
+                else:
+                    values["status"] = JobStatus.QUEUED
+                    values["run_at"] = _now() + timedelta(seconds=backoff(job_row.attempts))
+                    log.warning("job %s (%s) failed, attempt %s/%s", job_row.id, job_row.kind, job_row.attempts, job_row.max_attempts)
+                session.execute(update(Job).where(Job.id == job_row.id).values(**values))
+            session.commit()
+
+    def _run(self, handler: _Handler, jobs: List[Job]) -> None:
+        jobs = self.heartbeat(jobs)
+        if not jobs:
+            return
+        try:
+            with Session(self.engine) as session:
+                if handler.batch:
+                    handler.fn(session, [j.payload for j in jobs])
+                else:
+                    handler.fn(session, jobs[0].payload)
+                self._done(session, jobs)
+                session.commit()
+        except Exception:
+            self._failed(jobs, traceback.format_exc())
+
+    def run_once(self) -> int:
+        jobs = self.claim()
+
+        by_kind: Dict[str, List[Job]] = {}
+        for job_row in jobs:
+            by_kind.setdefault(job_row.kind, []).append(job_row)
+
+        for kind, group in by_kind.items():
+            handler = _handlers.get(kind)
+            if handler is None:
+                for job_row in group:
+                    job_row.attempts = job_row.max_attempts # nothing to retry with
+                self._failed(group, "no handler registered for {!r}".format(kind))
+            elif handler.batch:
+                self._run(handler, group)
+            else:
+                for job_row in group:
+                    self._run(handler, [job_row])
+
+        return len(jobs)
+
+    def run(self, once: bool = False) -> None:
+        log.info("worker %s started", self.worker_id)
+        last_requeue = None
+        while not self._stop.is_set():
+            try:
+                if last_requeue is None or time.monotonic() - last_requeue >= JOBS_REQUEUE_INTERVAL:
+                    last_requeue = time.monotonic()
+                    self.requeue_stale()
+                claimed = self.run_once()
+            except Exception:
+                log.exception("worker %s: error while polling", self.worker_id)
+                claimed = 0
+            if claimed == 0:
+                if once:
+                    break
+                self._stop.wait(self.poll_interval)
+        log.info("worker %s stopped", self.worker_id)
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self.run, name="jobs-worker", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+# ---------- CLI ----------
+
+def _stats(engine) -> None:
+    with Session(engine) as session:
+        rows = session.exec(
+            select(Job.kind, Job.status, func.count(Job.id)).group_by(Job.kind, Job.status)
+        ).all()
+    for kind, job_status, count in rows:
+        print("{:<30} {:<10} {}".format(kind, job_status.value, count))
+
+def _retry_failed(engine, kind: Optional[str]) -> None:
+    with Session(engine) as session:
+        stmt = (
+            update(Job)
+            .where(Job.status == JobStatus.FAILED)
+            .values(status=JobStatus.QUEUED, attempts=0, run_at=_now())
+        )
+        if kind:
+            stmt = stmt.where(Job.kind == kind)
+        result = session.execute(stmt)
+        session.commit()
+    print("requeued {} jobs".format(result.rowcount))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carisma job queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    worker_p = sub.add_parser("worker", help="run a worker")
+    worker_p.add_argument("--batch-size", type=int, default=JOBS_BATCH_SIZE)
+    worker_p.add_argument("--poll-interval", type=float, default=JOBS_POLL_INTERVAL)
+    worker_p.add_argument("--kinds", default=None, help="comma separated kinds to run (default: all)")
+    worker_p.add_argument("--once", action="store_true", help="exit when nothing is due")
+
+    sub.add_parser("stats", help="count jobs by kind and status")
+
+    retry_p = sub.add_parser("retry-failed", help="requeue permanently failed jobs")
+    retry_p.add_argument("--kind", default=None)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Importing the app registers every handler and gives us its engine. This file
+    # runs as __main__, the handlers are registered in the `jobs` module main imports,
+    # so everything below must come from that module, not from this one.
+    import main
+    import jobs
+
+    if args.command == "worker":
+        worker = jobs.Worker(
+            main.get_engine(),
+            batch_size=args.batch_size,
+            poll_interval=args.poll_interval,
+            kinds=args.kinds.split(",") if args.kinds else None,
+        )
+        signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+        signal.signal(signal.SIGINT, lambda *_: worker.stop())
+        worker.run(once=args.once)
+    elif args.command == "stats":
+        jobs._stats(main.get_engine())
+    elif args.command == "retry-failed":
+        jobs._retry_failed(main.get_engine(), args.kind)
@@ -1,19 +1,22 @@
 # main.py
 
-# TODO: Validations of privileges needed
-
 # ---------- IMPORTS ----------
 
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List
+from typing import Optional, List, Dict
 import random
+import asyncio
+import json
 import secrets
 import base64
 import hashlib
 
-from fastapi import FastAPI, HTTPException, Depends, Header, status, APIRouter
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, status, APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlmodel import SQLModel, Session, create_engine, select
-from sqlalchemy import func
+from sqlalchemy import func, or_, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import selectinload
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
@@ -24,6 +27,13 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 JWT_SECRET = os.getenv("JWT_SECRET")
 JWT_ALG = os.getenv("JWT_ALG")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # admin endpoints are disabled when unset
+JOBS_IN_PROCESS = os.getenv("JOBS_IN_PROCESS", "0") == "1" # run a job worker thread inside the API
+DB_ECHO = os.getenv("DB_ECHO", "1") == "1" # SQL logs, gunicorn.conf.py turns them off
+DB_CREATE_ALL = os.getenv("DB_CREATE_ALL", "1") == "1" # gunicorn.conf.py does it once in the master
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5")) # per worker process
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # below MySQL's wait_timeout
 
 from models import (
     User,
@@ -38,21 +48,74 @@ from models import (
 )
 
 from schemas import *
+from jobs import Worker
+import bulk
+import realtime
+import media
+import permissions
+import votes
+import profiling
 
 # ---------- APP ----------
 
-engine = create_engine(
-    DATABASE_URL,
-    echo=True, # set to True to see SQL logs
-    pool_pre_ping=True,
-)
+# The engine (and its pool) is created on first use, not at import: with a
+# preloaded app the import happens in the gunicorn master and the sockets would
+# be shared by every forked worker.
+engine = None
+ready = False
+
+def _create_engine():
+    new_engine = create_engine(
+        DATABASE_URL,
+        echo=DB_ECHO,
+        pool_pre_ping=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+    profiling.instrument(new_engine) # SQL timings, only recorded for profiled requests
+    return new_engine
+
+def get_engine():
+    global engine
+    if engine is None:
+        engine = _create_engine()
+    return engine
+
+def dispose_engine() -> None:
+    # After a fork: drop the parent's pool without closing its connections
+    global engine
+    if engine is not None:
+        engine.dispose(close=False)
+        engine = None
+
+def create_tables() -> None:
+    tmp_engine = _create_engine()
+    SQLModel.metadata.create_all(tmp_engine)
+    tmp_engine.dispose()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # startup
-    SQLModel.metadata.create_all(engine)
+    # startup (runs in each worker, after the fork)
+    global ready
+    if DB_CREATE_ALL:
+        SQLModel.metadata.create_all(get_engine())
+    worker = Worker(get_engine()) if JOBS_IN_PROCESS else None
+    if worker:
+        worker.start()
+    await realtime.hub.start()
+    permissions_task = await permissions.start(get_engine())
+    votes.start()
+    media.start()
+    ready = True
     yield
-    # shutdown
+    # shutdown (the server has already stopped taking connections)
+    ready = False
+    media.stop()
+    permissions_task.cancel()
+    await realtime.hub.stop()
+    if worker:
+        await run_in_threadpool(worker.stop, timeout=10) # joins the thread, off the loop
 
 app = FastAPI(lifespan=lifespan)
 v1 = APIRouter(prefix="/v1")
@@ -62,7 +125,7 @@ v1 = APIRouter(prefix="/v1")
 # ---- Basic Helpers ----
 
 def get_session():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
 def _unauthorized(detail: str = "Unauthorized") -> None:
@@ -156,6 +219,29 @@ def get_optional_current_user(
         return None
     return get_current_user(session=session, authorization=authorization)
 
+def _is_admin(token: Optional[str]) -> bool:
+    if not ADMIN_TOKEN or not token:
+        return False
+    return secrets.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
+    if not _is_admin(x_admin_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin only")
+
+# ---- Permissions ----
+# Answered by the in-memory role index (see permissions.py), no query per check
+
+def check_can_view(session: Session, community_id: int, me: Optional[User], detail: str = "not found") -> None:
+    # Hidden is reported as missing, private communities don't leak their existence
+    permissions.index.ensure(session, [community_id])
+    if not permissions.index.can_view(community_id, me.id if me else None):
+        raise HTTPException(status_code=404, detail=detail)
+
+def check_can_participate(session: Session, community_id: int, me: User) -> None:
+    permissions.index.ensure(session, [community_id])
+    if not permissions.index.can_participate(community_id, me.id):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="not allowed in this community")
+
 # ---- Getters ----
 # (By id or name)
 # TODO: Names don't represent what they return
@@ -259,69 +345,108 @@ def get_community_out_public(
         created_at=community.created_at,
     )
 
-def get_post_out(
-    postid: int,
+def get_my_votes(
+    post_ids: List[int],
+    me: Optional[User],
     session: Session = Depends(get_session),
-    ) -> Optional[Post]:
-    post: Optional[Post] = None
-    if isinstance(postid, int):
-        likes_sq = (
-            select(func.count(PostVote.post_id))
-            .where(PostVote.post_id == Post.id, PostVote.value == 1)
-            .correlate(Post)
-            .scalar_subquery()
-        )
+    ) -> Dict[int, int]:
+    # post id -> my vote (0 = none), one post_votes query for whatever the cache misses
+    if not me or not post_ids:
+        return {}
+
+    user_id = me.id
+    my_votes, missing, version = votes.cache.get_many(user_id, post_ids)
+    if missing:
+        if votes.cache.enabled:
+            # The session's read snapshot may predate `version`: end it, so the lookup
+            # below starts a fresh one (same connection). Expires what the session loaded.
+            session.commit()
+        found = dict(session.exec(
+            select(PostVote.post_id, PostVote.value)
+            .where(PostVote.user_id == user_id, PostVote.post_id.in_(missing))
+        ).all())
+        fetched = {post_id: found.get(post_id, 0) for post_id in missing}
+        votes.cache.put_many(user_id, fetched, version)
+        my_votes.update(fetched)
+    return my_votes
+
+def get_posts_out(
+    postids: List[int],
+    session: Session = Depends(get_session),
+    me: Optional[User] = None,
+    ) -> List[PostOut]:
+    # The whole page in one query (plus one for my votes), in the order of postids
+    if not postids:
+        return []
 
-        dislikes_sq = (
-            select(func.count(PostVote.post_id))
-            .where(PostVote.post_id == Post.id, PostVote.value == -1)
-            .correlate(Post)
-            .scalar_subquery()
-        )
+    # Before the page is loaded, looking them up may expire the session's objects
+    my_votes = get_my_votes(postids, me, session=session)
 
-        comments_sq = (
-            select(func.count(Comment.post_id))
-            .where(Comment.post_id == Post.id, Comment.deleted_at.is_(None))
-            .correlate(Post)
-            .scalar_subquery()
-        )
+    likes_sq = (
+        select(func.count(PostVote.post_id))
+        .where(PostVote.post_id == Post.id, PostVote.value == 1)
+        .correlate(Post)
+        .scalar_subquery()
+    )
+
+    dislikes_sq = (
+        select(func.count(PostVote.post_id))
+        .where(PostVote.post_id == Post.id, PostVote.value == -1)
+        .correlate(Post)
+        .scalar_subquery()
+    )
 
-        stmt = (
-            select(Post, likes_sq, dislikes_sq, comments_sq)
-            .where(Post.id == postid)
-            .options(
-                selectinload(Post.author),
-                selectinload(Post.community),
-            )
+    comments_sq = (
+        select(func.count(Comment.post_id))
+        .where(Comment.post_id == Post.id, Comment.deleted_at.is_(None))
+        .correlate(Post)
+        .scalar_subquery()
+    )
+
+    stmt = (
+        select(Post, likes_sq, dislikes_sq, comments_sq)
+        .where(Post.id.in_(postids), Post.deleted_at.is_(None))
+        .options(
+            selectinload(Post.author),
+            selectinload(Post.community),
         )
+    )
 
-    row = session.exec(stmt).first()
-    
-    if not row:
-        return None
+    rows = session.exec(stmt).all()
+
+    posts: Dict[int, PostOut] = {}
+    for post, likes, dislikes, comments in rows:
+        posts[post.id] = PostOut( # TODO: to change to a more simplificated way
+            id=post.id,
+            community=CommunityBaseOut(
+                id=post.community.id,
+                name=post.community.name,
+                image_url=post.community.image_url,
+            ),
+            author=UserBaseOut(
+                id=post.author.id,
+                username=post.author.username,
+                image_url=post.author.image_url,
+            ),
+            title=post.title,
+            body=post.body,
+            image_url=post.image_url,
+            created_at=post.created_at,
+            likes=likes,
+            dislikes=dislikes,
+            comments=comments,
+            my_vote=my_votes.get(post.id) if me else None,
+        )
 
-    post, likes, dislikes, comments = row
+    return [posts[postid] for postid in postids if postid in posts]
 
-    return PostOut( # TODO: to change to a more simplificated way
-        id=post.id,
-        community_id=CommunityBaseOut(
-            id=post.community.id,
-            name=post.community.name,
-            image_url=post.community.image_url,
-        ),
-        author=UserBaseOut(
-            id=post.author.id,
-            username=post.author.username,
-            image_url=post.author.image_url,
-        ),
-        title=post.title,
-        body=post.body,
-        image_url=post.image_url,
-        created_at=post.created_at,
-        likes=likes,
-        dislikes=dislikes,
-        comments=comments
-    )
+def get_post_out(
+    postid: int,
+    session: Session = Depends(get_session),
+    me: Optional[User] = None,
+    ) -> Optional[PostOut]:
+    posts = get_posts_out([postid], session=session, me=me)
+    return posts[0] if posts else None
 
 # ---- API ENDPOINTS ----
 
@@ -429,8 +554,19 @@ def new_community(
         owner_user_id=me.id,
     )
     session.add(community)
+    session.flush()
+    session.add(CommunityRoleAssignment(
+        community_id=community.id,
+        user_id=me.id,
+        role=CommunityRole.OWNER,
+        granted_by_user_id=me.id,
+    ))
     session.commit()
     session.refresh(community)
+
+    permissions.community_changed(community.id, community.type, community.owner_user_id)
+    permissions.role_changed(community.id, me.id, CommunityRole.OWNER)
+
     return CommunityPublicOut(
         id=community.id,
         name=community.name,
@@ -450,10 +586,92 @@ def get_community(
     me: User = Depends(get_current_user),
 ):
     community = get_community_out_public(community_str, session=session)
-    if not community or community.deleted_at is not None:
+    if not community:
         raise HTTPException(status_code=404, detail="community not found")
+    check_can_view(session, community.id, me, "community not found") # also hides deleted ones
     return community
 
+@v1.put("/communities/{community_str}/roles/{user_id}", response_model=CommunityRoleOut)
+def set_community_role(
+    community_str: str,
+    user_id: int,
+    payload: CommunityRolePayload,
+    session: Session = Depends(get_session),
+    me: User = Depends(get_current_user),
+):
+    community = get_community_base(community_str, session=session)
+    if not community:
+        raise HTTPException(status_code=404, detail="community not found")
+    check_can_view(session, community.id, me, "community not found")
+
+    my_role = permissions.index.role(community.id, me.id)
+    their_role = permissions.index.role(community.id, user_id)
+    if my_role < permissions.MOD:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="mods only")
+    if user_id == community.owner_user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="the owner's role can't be changed")
+    if my_role < permissions.OWNER and (payload.role == CommunityRole.MOD or their_role >= permissions.MOD):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="only the owner manages mods")
+
+    if not session.get(User, user_id):
+        raise HTTPException(status_code=404, detail="user not found")
+
+    assignment = session.get(CommunityRoleAssignment, (community.id, user_id))
+    if assignment:
+        assignment.role = payload.role
+        assignment.granted_by_user_id = me.id
+    else:
+        assignment = CommunityRoleAssignment(
+            community_id=community.id,
+            user_id=user_id,
+            role=payload.role,
+            granted_by_user_id=me.id,
+        )
+        session.add(assignment)
+    session.commit()
+    session.refresh(assignment)
+
+    permissions.role_changed(community.id, user_id, assignment.role)
+
+    return CommunityRoleOut(
+        community_id=assignment.community_id,
+        user_id=assignment.user_id,
+        role=assignment.role,
+        granted_by_user_id=assignment.granted_by_user_id,
+        created_at=assignment.created_at,
+    )
+
+@v1.delete("/communities/{community_str}/roles/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+def remove_community_role(
+    community_str: str,
+    user_id: int,
+    session: Session = Depends(get_session),
+    me: User = Depends(get_current_user),
+):
+    # Mods remove others, anyone can leave (but not lift their own ban)
+    community = get_community_base(community_str, session=session)
+    if not community:
+        raise HTTPException(status_code=404, detail="community not found")
+    check_can_view(session, community.id, me, "community not found")
+
+    my_role = permissions.index.role(community.id, me.id)
+    their_role = permissions.index.role(community.id, user_id)
+    if user_id == community.owner_user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="the owner's role can't be changed")
+    if user_id == me.id:
+        if their_role == permissions.BANNED:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="banned")
+    elif my_role < permissions.MOD or (my_role < permissions.OWNER and their_role >= permissions.MOD):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="mods only")
+
+    assignment = session.get(CommunityRoleAssignment, (community.id, user_id))
+    if not assignment:
+        raise HTTPException(status_code=404, detail="role not found")
+    session.delete(assignment)
+    session.commit()
+
+    permissions.role_changed(community.id, user_id, None)
+
 
 # ---- Posts ----
 
@@ -463,10 +681,16 @@ def get_5_random_posts(
     session: Session = Depends(get_session),
     me: Optional[User] = Depends(get_optional_current_user),
 ):
-    _ = me
+    # Private communities are filtered in the same query, widened by the
+    # private ones the user belongs to (from the role index)
+    visible = or_(
+        Community.type != CommunityType.PRIVATE,
+        Post.community_id.in_(permissions.index.private_member_of(me.id if me else None)),
+    )
     ids = session.exec(
         select(Post.id)
-        .where(Post.deleted_at.is_(None))
+        .join(Community, Community.id == Post.community_id)
+        .where(Post.deleted_at.is_(None), Community.deleted_at.is_(None), visible)
         .order_by(func.random())
         .limit(5) # From here the limit
     ).all()
@@ -474,11 +698,7 @@ def get_5_random_posts(
     if not ids:
         return []
 
-    # super simple response
-    return [
-        get_post_out(id, session=session)
-        for id in ids
-    ]
+    return get_posts_out(ids, session=session, me=me)
     
 @v1.post("/posts", response_model=PostOut, status_code=status.HTTP_201_CREATED)
 def new_post(
@@ -486,9 +706,11 @@ def new_post(
     session: Session = Depends(get_session),
     me: User = Depends(get_current_user),
 ):
-    community = get_community(payload.community, session=session)
-    if not community or community.deleted_at is not None:
+    community = get_community_base(payload.community, session=session)
+    if not community:
         raise HTTPException(status_code=404, detail="community not found")
+    check_can_view(session, community.id, me, "community not found")
+    check_can_participate(session, community.id, me)
 
     post = Post(
         community_id=community.id,
@@ -500,15 +722,7 @@ def new_post(
     session.add(post)
     session.commit()
     session.refresh(post)
-    return PostOut(
-        id=post.id,
-        community_id=post.community_id,
-        author_user_id=post.author_user_id,
-        title=post.title,
-        body=post.body,
-        image_url=post.image_url,
-        created_at=post.created_at,
-    )
+    return get_post_out(post.id, session=session, me=me)
 
 @v1.get("/posts/{post_id}", response_model=PostOut)
 def get_post(
@@ -516,31 +730,315 @@ def get_post(
     session: Session = Depends(get_session),
     me: Optional[User] = Depends(get_optional_current_user),
 ):
-    _ = me
-    post = get_post_out(post_id, session=session)
+    post = get_post_out(post_id, session=session, me=me)
+    if not post:
+        raise HTTPException(status_code=404, detail="post not found")
+    check_can_view(session, post.community.id, me, "post not found")
+
+    return post
+
+@v1.put("/posts/{post_id}/vote", response_model=PostOut)
+def vote_post(
+    post_id: int,
+    payload: PostThumbPayload,
+    session: Session = Depends(get_session),
+    me: User = Depends(get_current_user),
+):
+    post = session.get(Post, post_id)
     if not post or post.deleted_at is not None:
         raise HTTPException(status_code=404, detail="post not found")
+    check_can_view(session, post.community_id, me, "post not found")
+    check_can_participate(session, post.community_id, me)
+
+    new = payload.value
+    for attempt in (1, 2):
+        vote = session.get(PostVote, (post_id, me.id))
+        if vote:
+            # Locked: a concurrent vote of the same user waits, so `old` is the real one
+            session.refresh(vote, with_for_update=True)
+        old = vote.value if vote else 0
+
+        if new == 0:
+            if vote:
+                session.delete(vote)
+        elif vote:
+            vote.value = new
+        else:
+            session.add(PostVote(post_id=post_id, user_id=me.id, value=new))
+        try:
+            session.commit()
+            break
+        except IntegrityError:
+            # A concurrent first vote (double tap) got in first, this one becomes a change of it
+            session.rollback()
+            if attempt == 2:
+                raise
+
+    if old != new:
+        votes.vote_changed(me.id, post.id, new)
+        realtime.hub.publish_counts(
+            post.id,
+            post.community_id,
+            likes=(new == 1) - (old == 1),
+            dislikes=(new == -1) - (old == -1),
+        )
 
-    return PostOut(
-        id=post.id,
-        community_id=post.community_id,
-        author_user_id=post.author_user_id,
-        title=post.title,
-        body=post.body,
-        image_url=post.image_url,
-        created_at=post.created_at,
-        likes=post.likes,
-        dislikes=post.dislikes,
-        comments=post.comments,
+    return get_post_out(post.id, session=session, me=me)
+
+# ---- Comments ----
+
+@v1.post("/posts/{post_id}/comments", response_model=CommentOut, status_code=status.HTTP_201_CREATED)
+def new_comment(
+    post_id: int,
+    payload: CommentCreatePayload,
+    session: Session = Depends(get_session),
+    me: User = Depends(get_current_user),
+):
+    post = session.get(Post, post_id)
+    if not post or post.deleted_at is not None:
+        raise HTTPException(status_code=404, detail="post not found")
+    check_can_view(session, post.community_id, me, "post not found")
+    check_can_participate(session, post.community_id, me)
+
+    if payload.parent_comment_id is not None:
+        parent = session.get(Comment, payload.parent_comment_id)
+        if not parent or parent.post_id != post.id or parent.deleted_at is not None:
+            raise HTTPException(status_code=404, detail="parent comment not found")
+
+    comment = Comment(
+        post_id=post.id,
+        author_user_id=me.id,
+        parent_comment_id=payload.parent_comment_id,
+        body=payload.body,
     )
+    session.add(comment)
+    session.commit()
+    session.refresh(comment)
+
+    out = CommentOut(
+        id=comment.id,
+        post_id=comment.post_id,
+        parent_comment_id=comment.parent_comment_id,
+        author=UserBaseOut(
+            id=me.id,
+            username=me.username,
+            image_url=me.image_url,
+        ),
+        body=comment.body,
+        created_at=comment.created_at,
+    )
+    realtime.hub.publish_comment(post.id, post.community_id, out.model_dump(mode="json"))
+    realtime.hub.publish_counts(post.id, post.community_id, comments=1)
+    return out
+
+# ---- Realtime ----
+# Clients subscribe to post and community ids and get batches (JSON arrays) of
+# {"type": "counts"} deltas, {"type": "comment"} events and {"type": "resync"}.
+# {"type": "revoked", "community_id": ...} says its topics were dropped: the user may
+# no longer see that community.
+
+# Browsers can't set headers on these, so the token goes in ?token=
+
+def _realtime_user_id(token: Optional[str]) -> Optional[int]:
+    if not token:
+        return None
+    with Session(get_engine()) as session:
+        return get_current_user(session=session, authorization="Bearer " + token).id
+
+def _visible_topics(user_id: Optional[int], posts=(), communities=()) -> Dict[str, int]:
+    # topic -> community it belongs to
+    # One query for the posts' communities, then a bulk check on the role index
+    posts = {int(p) for p in posts}
+    communities = {int(c) for c in communities}
+    with Session(get_engine()) as session:
+        post_communities = dict(session.exec(
+            select(Post.id, Post.community_id).where(Post.id.in_(posts), Post.deleted_at.is_(None))
+        ).all()) if posts else {}
+        permissions.index.ensure(session, communities | set(post_communities.values()))
+    visible = permissions.index.filter_visible(communities | set(post_communities.values()), user_id)
+    topics = {realtime.post_topic(p): c for p, c in post_communities.items() if c in visible}
+    topics.update({realtime.community_topic(c): c for c in communities if c in visible})
+    return topics
+
+@v1.websocket("/realtime")
+async def realtime_ws(websocket: WebSocket, token: Optional[str] = None):
+    # Messages: {"subscribe": {"posts": [1, 2], "communities": [3]}} / {"unsubscribe": {...}}
+    try:
+        user_id = await run_in_threadpool(_realtime_user_id, token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    conn = realtime.Connection(user_id)
+
+    async def send_loop():
+        while True:
+            await websocket.send_json(await conn.next_batch())
+
+    sender = asyncio.create_task(send_loop())
+    try:
+        while True:
+            message = await websocket.receive_json()
+            try:
+                if "subscribe" in message:
+                    topics = await run_in_threadpool(_visible_topics, user_id, **message["subscribe"])
+                    realtime.hub.subscribe(conn, topics)
+                if "unsubscribe" in message:
+                    realtime.hub.unsubscribe(conn, realtime.parse_topics(**message["unsubscribe"]))
+            except (TypeError, ValueError):
+                await websocket.send_json([{"type": "error", "detail": "bad message"}])
+    except (WebSocketDisconnect, ValueError):
+        pass
+    finally:
+        sender.cancel()
+        realtime.hub.drop(conn)
+
+@v1.get("/realtime/events")
+async def realtime_sse(
+    request: Request,
+    posts: List[int] = Query(default=[]),
+    communities: List[int] = Query(default=[]),
+    token: Optional[str] = None,
+):
+    # Server-Sent Events version of the websocket, for clients that only read
+    user_id = await run_in_threadpool(_realtime_user_id, token)
+    topics = await run_in_threadpool(_visible_topics, user_id, posts, communities)
+    conn = realtime.Connection(user_id)
+    realtime.hub.subscribe(conn, topics)
+
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    batch = await asyncio.wait_for(conn.next_batch(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "data: {}\n\n".format(json.dumps(batch, default=str))
+        finally:
+            realtime.hub.drop(conn)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# ---- Bulk ----
+
+@v1.post("/bulk/import", response_model=BulkImportResponse, dependencies=[Depends(require_admin)])
+async def bulk_import(
+    request: Request,
+    batch_size: int = Query(default=bulk.BULK_BATCH_SIZE, ge=1, le=10_000),
+    resume_from: int = Query(default=0, ge=0),
+    session: Session = Depends(get_session),
+):
+    # Body is NDJSON, read as a stream so the upload never sits in memory
+    importer = bulk.Importer(session, batch_size=batch_size, resume_from=resume_from)
+    try:
+        async for line in bulk.aiter_lines(request.stream()):
+            if importer.feed(line):
+                await run_in_threadpool(importer.flush)
+        await run_in_threadpool(importer.flush)
+    except bulk.BulkImportError as e:
+        raise HTTPException(
+            status_code=422,
+            detail={"line": e.line, "checkpoint": e.checkpoint, "error": e.error},
+        )
+    return importer.result()
+
+@v1.get("/bulk/export", dependencies=[Depends(require_admin)])
+def bulk_export(kinds: Optional[str] = None):
+    try:
+        wanted = bulk.parse_kinds(kinds)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return StreamingResponse(bulk.export_ndjson(get_engine(), wanted), media_type="application/x-ndjson")
+
+# ---- Media ----
+
+@v1.post("/media", response_model=MediaOut, status_code=status.HTTP_201_CREATED)
+async def upload_media(
+    request: Request,
+    me: User = Depends(get_current_user),
+):
+    # Raw image bytes as the body; use the returned url as image_url of a post or user
+    try:
+        digest, ext, size, deduplicated = await media.store(request.stream())
+    except media.MediaError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    media.schedule_thumbnails(digest, ext)
+    url = media.url_for(digest, media.original_name(digest, ext))
+    return MediaOut(
+        url=url,
+        thumbnails=media.thumbnail_urls(url),
+        size=size,
+        deduplicated=deduplicated,
+    )
+
+@app.get(media.MEDIA_URL + "/{a}/{b}/{name}", include_in_schema=False)
+def get_media(a: str, b: str, name: str):
+    path, immutable = media.resolve(a, b, name)
+    if not path:
+        raise HTTPException(status_code=404, detail="media not found")
+    # FileResponse uses sendfile when the server offers it (zerocopysend)
+    return FileResponse(path, headers={"Cache-Control": media.CACHE_FOREVER if immutable else "public, max-age=60"})
+# ---- Profiling ----
+# See profiling.py. `X-Profile: <ADMIN_TOKEN>` profiles one request.
+
+# Not installed at all when nothing can turn it on
+if ADMIN_TOKEN or profiling.PROFILE_SAMPLE_RATE or profiling.PROFILE_SLOW_MS:
+    app.add_middleware(profiling.ProfilingMiddleware, is_forced=_is_admin)
+
+@v1.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles():
+    # Slowest first, without the SQL and stacks (download one for those)
+    return profiling.list_profiles()
+
+@v1.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def download_profile(profile_id: str):
+    path = profiling.profile_path(profile_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return FileResponse(path, media_type="application/json", filename="profile-{}.json".format(profile_id))
+
+
+# ---- Health ----
+# Outside /v1, for the load balancer / orchestrator
+
+@app.get("/health", include_in_schema=False)
+def health():
+    # Liveness: the process answers
+    return {"status": "ok"}
+
+@app.get("/ready", include_in_schema=False)
+def readiness():
+    # Readiness: started and the DB pool can hand out a working connection
+    if not ready:
+        raise HTTPException(status_code=503, detail="not ready")
+
+    pool = get_engine().pool
+    pool_status = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+    if pool.checkedout() >= DB_POOL_SIZE + DB_MAX_OVERFLOW:
+        raise HTTPException(status_code=503, detail={"error": "pool exhausted", "pool": pool_status})
+
+    try:
+        with get_engine().connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        raise HTTPException(status_code=503, detail={"error": "database unavailable: {}".format(type(e).__name__), "pool": pool_status})
 
+    return {"status": "ready", "pid": os.getpid(), "pool": pool_status}
 
 
 app.include_router(v1)
 
 if __name__ == "__main__":
-    # Create tables if you want (usually do this in a migration tool instead)
-    # SQLModel.metadata.create_all(engine)
+    # Development server, single process. In production use gunicorn (see gunicorn.conf.py):
+    #   gunicorn main:app
 
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
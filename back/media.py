@@ -0,0 +1,207 @@
+# media.py
+
+# Content-addressed image storage. An upload is stored once under its sha256,
+#
+#   MEDIA_ROOT/ab/cd/abcd...ef.jpg            -> MEDIA_URL/ab/cd/abcd...ef.jpg
+#   MEDIA_ROOT/ab/cd/abcd...ef_320.webp       -> thumbnail, longest side 320px
+#
+# so uploading the same picture twice gives back the same url, and a url never
+# changes content (safe to cache forever). Thumbnails are made by a process pool
+# after the upload has returned; until one exists the original is served instead.
+
+# ---------- IMPORTS ----------
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import AsyncIterable, Dict, Optional, Tuple
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+
+from starlette.concurrency import run_in_threadpool
+
+MEDIA_ROOT = os.path.abspath(os.getenv("MEDIA_ROOT", "media"))
+MEDIA_URL = os.getenv("MEDIA_URL", "/media").rstrip("/")
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2")) # thumbnail processes per API worker
+THUMB_SIZES = (64, 320, 640)
+WRITE_BUFFER = 1024 * 1024 # bytes of upload collected before each write off the loop
+
+CACHE_FOREVER = "public, max-age=31536000, immutable"
+
+log = logging.getLogger("carisma.media")
+
+# Checked against the bytes, the Content-Type header is not trusted
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+_NAME_RE = re.compile(r"^(?P<hash>[0-9a-f]{64})(?:_(?P<size>\d+))?\.(?P<ext>jpg|png|gif|webp)$")
+_URL_RE = re.compile(r"^" + re.escape(MEDIA_URL) + r"/[0-9a-f]{2}/[0-9a-f]{2}/(?P<hash>[0-9a-f]{64})\.(?:jpg|png|gif|webp)$")
+
+class MediaError(ValueError):
+    pass
+
+# ---------- PATHS / URLS ----------
+
+def _relative(digest: str, name: str) -> str:
+    return "{}/{}/{}".format(digest[:2], digest[2:4], name)
+
+def original_name(digest: str, ext: str) -> str:
+    return "{}.{}".format(digest, ext)
+
+def thumbnail_name(digest: str, size: int) -> str:
+    return "{}_{}.webp".format(digest, size)
+
+def url_for(digest: str, name: str) -> str:
+    return "{}/{}".format(MEDIA_URL, _relative(digest, name))
+
+def thumbnail_urls(image_url: Optional[str]) -> Dict[str, str]:
+    # External urls (imported posts, old rows) have no thumbnails
+    match = _URL_RE.match(image_url) if image_url else None
+    if not match:
+        return {}
+    digest = match.group("hash")
+    return {str(size): url_for(digest, thumbnail_name(digest, size)) for size in THUMB_SIZES}
+
+def resolve(a: str, b: str, name: str) -> Tuple[Optional[str], bool]:
+    """Map a media url back to a file. Returns (path, immutable).
+
+    A thumbnail that is not ready yet resolves to its original, which must not be
+    cached forever under the thumbnail's url.
+    """
+    match = _NAME_RE.match(name)
+    if not match or a != match.group("hash")[:2] or b != match.group("hash")[2:4]:
+        return None, False
+
+    path = os.path.join(MEDIA_ROOT, a, b, name)
+    if os.path.isfile(path):
+        return path, True
+
+    if match.group("size"):
+        digest = match.group("hash")
+        for ext in ("jpg", "png", "gif", "webp"):
+            original = os.path.join(MEDIA_ROOT, a, b, original_name(digest, ext))
+            if os.path.isfile(original):
+                return original, False
+    return None, False
+
+# ---------- STORE ----------
+
+def _sniff(head: bytes) -> Optional[str]:
+    for signature, ext in _SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+async def store(chunks: AsyncIterable[bytes]) -> Tuple[str, str, int, bool]:
+    """Stream an upload to disk while hashing it. Returns (digest, ext, size, deduplicated)."""
+    tmp_dir = os.path.join(MEDIA_ROOT, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    sha = hashlib.sha256()
+    size = 0
+    head = b""
+    buffer = bytearray()
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    raise MediaError("file too large (max {} bytes)".format(MEDIA_MAX_BYTES))
+                if len(head) < 16:
+                    head += chunk[:16]
+                sha.update(chunk)
+                buffer += chunk
+                if len(buffer) >= WRITE_BUFFER:
+                    # Disk writes never block the event loop
+                    await run_in_threadpool(f.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await run_in_threadpool(f.write, bytes(buffer))
+
+        ext = _sniff(head)
+        if ext is None:
+            raise MediaError("unsupported image type (jpeg, png, gif or webp)")
+
+        digest = sha.hexdigest()
+        path = os.path.join(MEDIA_ROOT, _relative(digest, original_name(digest, ext)))
+        if os.path.exists(path):
+            return digest, ext, size, True
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return digest, ext, size, False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# ---------- THUMBNAILS ----------
+
+def _make_thumbnails(src: str, digest: str) -> None:
+    # Runs in the process pool, keep it importable and free of app state
+    from PIL import Image, ImageOps
+
+    out_dir = os.path.dirname(src)
+    if _thumbnails_done(out_dir, digest):
+        return # done meanwhile by another job
+
+    with Image.open(src) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        for size in THUMB_SIZES:
+            path = os.path.join(out_dir, thumbnail_name(digest, size))
+            if os.path.exists(path):
+                continue
+            thumb = image.copy()
+            thumb.thumbnail((size, size))
+            # A name of its own: the same image may be processed by two jobs at once
+            fd, tmp = tempfile.mkstemp(dir=out_dir, suffix=".tmp")
+            os.close(fd)
+            try:
+                thumb.save(tmp, "WEBP", quality=80, method=4)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+def _thumbnails_done(out_dir: str, digest: str) -> bool:
+    return all(os.path.exists(os.path.join(out_dir, thumbnail_name(digest, size))) for size in THUMB_SIZES)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def start() -> None:
+    # From the lifespan, so every API worker has its own pool. Its processes come from
+    # a forkserver (spawn where there is none, e.g. Windows), never forked from this
+    # worker (threads running, DB sockets open).
+    global _pool
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    _pool = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, mp_context=multiprocessing.get_context(method))
+
+def stop() -> None:
+    global _pool
+    if _pool:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _log_failure(future: Future) -> None:
+    if not future.cancelled() and future.exception():
+        log.error("thumbnail generation failed", exc_info=future.exception())
+
+def schedule_thumbnails(digest: str, ext: str) -> None:
+    src = os.path.join(MEDIA_ROOT, _relative(digest, original_name(digest, ext)))
+    if _thumbnails_done(os.path.dirname(src), digest):
+        return # deduplicated upload
+    if _pool is None:
+        _make_thumbnails(src, digest) # not started (CLI, scripts)
+        return
+    _pool.submit(_make_thumbnails, src, digest).add_done_callback(_log_failure)
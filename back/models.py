@@ -5,6 +5,7 @@ from datetime import datetime, timezone
 from enum import Enum
 from typing import List, Optional
 
+from sqlalchemy import JSON, Column, Index
 from sqlmodel import Field, Relationship, SQLModel, UniqueConstraint
 
 
@@ -29,6 +30,12 @@ class CommunityRole(str, Enum):
     BANNED = "banned"
 
 
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    FAILED = "failed"
+
+
 # ---------- Tables ----------
 
 class User(SQLModel, table=True):
@@ -205,4 +212,28 @@ class CommentVote(SQLModel, table=True):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
 
     comment: "Comment" = Relationship(back_populates="votes")
-    user: "User" = Relationship(back_populates="comment_votes")
\ No newline at end of file
+    user: "User" = Relationship(back_populates="comment_votes")
+
+
+class Job(SQLModel, table=True):
+    __tablename__ = "jobs"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str = Field(index=True, nullable=False)
+    payload: dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
+
+    priority: int = Field(default=0, nullable=False) # higher runs first
+    status: JobStatus = Field(default=JobStatus.QUEUED, nullable=False)
+    attempts: int = Field(default=0, nullable=False)
+    max_attempts: int = Field(default=5, nullable=False)
+    run_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
+
+    locked_by: Optional[str] = Field(default=None)
+    locked_at: Optional[datetime] = Field(default=None)
+    last_error: Optional[str] = Field(default=None)
+
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
+
+    __table_args__ = (
+        Index("ix_jobs_claim", "status", "priority", "run_at"),
+    )
@@ -0,0 +1,256 @@
+# permissions.py
+
+# Who can see and write in which community, answered from memory.
+#
+# Every worker keeps (community -> type), (community -> owner) and
+# (community -> user -> role) as small ints, loaded at startup. The owner is read from
+# `Community.owner_user_id`, so communities without an OWNER assignment row (older or
+# bulk imported ones) still have theirs. Role and community changes are applied to the local index
+# right away and broadcast to the other workers through the realtime backend; a
+# periodic full reload covers anything a worker missed (e.g. no Redis configured).
+#
+#   PUBLIC      anyone sees it, anyone not banned posts/comments/votes
+#   RESTRICTED  anyone sees it, only members (and mods/owner) post/comment/vote
+#   PRIVATE     only members (and mods/owner) see it or do anything in it
+
+# ---------- IMPORTS ----------
+
+from typing import Dict, Iterable, List, Optional, Set
+import asyncio
+import logging
+import os
+import threading
+
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from models import Community, CommunityRole, CommunityRoleAssignment, CommunityType
+import realtime
+
+PERMISSIONS_RELOAD_SECONDS = int(os.getenv("PERMISSIONS_RELOAD_SECONDS", "300"))
+TOPIC = "internal:permissions"
+
+log = logging.getLogger("carisma.permissions")
+
+# Higher is more privileges, so checks are comparisons
+BANNED = -1
+NONE = 0
+MEMBER = 1
+MOD = 2
+OWNER = 3
+
+ROLE_CODES = {
+    CommunityRole.BANNED: BANNED,
+    CommunityRole.MEMBER: MEMBER,
+    CommunityRole.MOD: MOD,
+    CommunityRole.OWNER: OWNER,
+}
+
+DELETED = -1 # community type code for deleted communities, unknown ids read the same
+TYPE_CODES = {
+    CommunityType.PUBLIC: 0,
+    CommunityType.RESTRICTED: 1,
+    CommunityType.PRIVATE: 2,
+}
+_PUBLIC = TYPE_CODES[CommunityType.PUBLIC]
+_PRIVATE = TYPE_CODES[CommunityType.PRIVATE]
+
+# ---------- INDEX ----------
+
+class RoleIndex:
+    def __init__(self):
+        self._types: Dict[int, int] = {}
+        self._owners: Dict[int, int] = {}
+        self._roles: Dict[int, Dict[int, int]] = {}
+        self._private: Set[int] = set()
+        self._lock = threading.Lock() # changes come from the threadpool and the loop
+        self._changes: Optional[List[tuple]] = None # made while a load runs, replayed on its result
+
+    # ---- Loading ----
+
+    def load(self, engine) -> None:
+        with self._lock:
+            self._changes = []
+        try:
+            self._load(engine)
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def _load(self, engine) -> None:
+        types: Dict[int, int] = {}
+        owners: Dict[int, int] = {}
+        roles: Dict[int, Dict[int, int]] = {}
+        with Session(engine) as session:
+            for community_id, community_type, deleted_at, owner_user_id in session.exec(
+                select(Community.id, Community.type, Community.deleted_at, Community.owner_user_id)
+                .execution_options(yield_per=5000)
+            ):
+                types[community_id] = DELETED if deleted_at is not None else TYPE_CODES[community_type]
+                owners[community_id] = owner_user_id
+            for community_id, user_id, role in session.exec(
+                select(
+                    CommunityRoleAssignment.community_id,
+                    CommunityRoleAssignment.user_id,
+                    CommunityRoleAssignment.role,
+                ).execution_options(yield_per=5000)
+            ):
+                roles.setdefault(community_id, {})[user_id] = ROLE_CODES[role]
+
+        # Swap whole dicts, readers never see a half loaded index. Changes applied while
+        # the DB was read may be missing from it, so they are applied again on top.
+        private = {c for c, t in types.items() if t == _PRIVATE}
+        with self._lock:
+            self._types = types
+            self._owners = owners
+            self._roles = roles
+            self._private = private
+            for change in self._changes:
+                change[0](*change[1:])
+        log.info("permissions loaded: %s communities, %s roles", len(types), sum(len(r) for r in roles.values()))
+
+    def ensure(self, session: Session, community_ids: Iterable[int]) -> None:
+        # Communities created after the last load (in another worker) are fetched once.
+        # Ids not in the DB are not remembered: they come from clients, and one could
+        # be created right after being probed.
+        missing = {c for c in community_ids if c not in self._types}
+        if not missing:
+            return
+
+        found: Set[int] = set()
+        for community_id, community_type, deleted_at, owner_user_id in session.exec(
+            select(Community.id, Community.type, Community.deleted_at, Community.owner_user_id)
+            .where(Community.id.in_(missing))
+        ):
+            self.set_community(community_id, None if deleted_at is not None else community_type, owner_user_id)
+            found.add(community_id)
+
+        if found:
+            for community_id, user_id, role in session.exec(
+                select(
+                    CommunityRoleAssignment.community_id,
+                    CommunityRoleAssignment.user_id,
+                    CommunityRoleAssignment.role,
+                ).where(CommunityRoleAssignment.community_id.in_(found))
+            ):
+                self.set_role(community_id, user_id, role)
+
+    # ---- Incremental updates ----
+
+    def set_community(self, community_id: int, community_type: Optional[CommunityType], owner_user_id: Optional[int] = None) -> None:
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((self._set_community, community_id, community_type, owner_user_id))
+            self._set_community(community_id, community_type, owner_user_id)
+
+    def _set_community(self, community_id: int, community_type: Optional[CommunityType], owner_user_id: Optional[int]) -> None:
+        code = DELETED if community_type is None else TYPE_CODES[CommunityType(community_type)]
+        self._types[community_id] = code
+        if owner_user_id is not None:
+            self._owners[community_id] = owner_user_id
+        if code == _PRIVATE:
+            self._private.add(community_id)
+        else:
+            self._private.discard(community_id)
+
+    def set_role(self, community_id: int, user_id: int, role: Optional[CommunityRole]) -> None:
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((self._set_role, community_id, user_id, role))
+            self._set_role(community_id, user_id, role)
+
+    def _set_role(self, community_id: int, user_id: int, role: Optional[CommunityRole]) -> None:
+        if role is None:
+            self._roles.get(community_id, {}).pop(user_id, None)
+        else:
+            self._roles.setdefault(community_id, {})[user_id] = ROLE_CODES[CommunityRole(role)]
+
+    def apply(self, event: dict) -> None:
+        if event["type"] == "role":
+            self.set_role(event["community_id"], event["user_id"], event["role"])
+        elif event["type"] == "community":
+            self.set_community(event["community_id"], event["community_type"], event.get("owner_user_id"))
+
+    # ---- Checks ----
+
+    def role(self, community_id: int, user_id: Optional[int]) -> int:
+        if user_id is None:
+            return NONE
+        if self._owners.get(community_id) == user_id:
+            return OWNER
+        return self._roles.get(community_id, {}).get(user_id, NONE)
+
+    def can_view(self, community_id: int, user_id: Optional[int]) -> bool:
+        community_type = self._types.get(community_id, DELETED)
+        if community_type == DELETED:
+            return False
+        if community_type == _PRIVATE:
+            return self.role(community_id, user_id) >= MEMBER
+        return True
+
+    def can_participate(self, community_id: int, user_id: Optional[int]) -> bool:
+        # Post, comment and vote
+        community_type = self._types.get(community_id, DELETED)
+        if community_type == DELETED or user_id is None:
+            return False
+        role = self.role(community_id, user_id)
+        if community_type == _PUBLIC:
+            return role != BANNED
+        return role >= MEMBER
+
+    def filter_visible(self, community_ids: Iterable[int], user_id: Optional[int]) -> Set[int]:
+        # Bulk version of can_view for feeds
+        return {c for c in set(community_ids) if self.can_view(c, user_id)}
+
+    def private_member_of(self, user_id: Optional[int]) -> List[int]:
+        # Private communities the user can see, to widen a "not private" SQL filter
+        if user_id is None:
+            return []
+        # Snapshot, set_community may change the set from another thread meanwhile
+        return [c for c in list(self._private) if self.role(c, user_id) >= MEMBER]
+
+index = RoleIndex()
+
+# ---------- CHANGES ----------
+
+def role_changed(community_id: int, user_id: int, role: Optional[CommunityRole]) -> None:
+    # Call after the commit: applied here at once, then in every other worker
+    event = {
+        "type": "role",
+        "community_id": community_id,
+        "user_id": user_id,
+        "role": role.value if role is not None else None,
+    }
+    index.apply(event)
+    realtime.hub.publish([TOPIC], event)
+
+def community_changed(community_id: int, community_type: Optional[CommunityType], owner_user_id: Optional[int] = None) -> None:
+    # community_type None means deleted, owner_user_id None keeps the known owner
+    event = {
+        "type": "community",
+        "community_id": community_id,
+        "community_type": community_type.value if community_type is not None else None,
+        "owner_user_id": owner_user_id,
+    }
+    index.apply(event)
+    realtime.hub.publish([TOPIC], event)
+
+def _revoke_subscriptions(event: dict) -> None:
+    # Open realtime connections were only checked when they subscribed
+    realtime.hub.revoke(event["community_id"], index.can_view)
+
+# ---------- LIFECYCLE ----------
+
+async def start(engine) -> asyncio.Task:
+    await run_in_threadpool(index.load, engine)
+    realtime.hub.listen(TOPIC, index.apply)
+    realtime.hub.listen(TOPIC, _revoke_subscriptions) # after apply, sees the new roles
+    return asyncio.create_task(_reload_forever(engine))
+
+async def _reload_forever(engine) -> None:
+    while True:
+        await asyncio.sleep(PERMISSIONS_RELOAD_SECONDS)
+        try:
+            await run_in_threadpool(index.load, engine)
+        except Exception:
+            log.exception("permissions reload failed, keeping the old index")
@@ -0,0 +1,322 @@
+# profiling.py
+
+# Opt-in request profiling: where did the time of this request go?
+#
+# A profiled request gets a sampling CPU profile of its handler (and dependencies)
+# plus every SQL statement with its timing. Requests are profiled when
+#
+#   - they carry `X-Profile: <ADMIN_TOKEN>` (the response says `X-Profile-Id`), or
+#   - they are picked at random, PROFILE_SAMPLE_RATE (0.0 - 1.0), or
+#   - PROFILE_SLOW_MS is set: every request records its SQL (cheap), and the ones
+#     slower than that are kept, without a CPU profile.
+#
+# Profiles are JSON files in PROFILE_DIR, shared by all workers of the machine:
+# the PROFILE_KEEP slowest sampled/slow requests and the PROFILE_KEEP latest ones
+# asked for by header. Admins list and download them at /v1/admin/profiles.
+# CPU stacks are in "folded" format (`a;b;c count`), ready for flamegraph tools.
+# Streaming responses (SSE, NDJSON export) and WebSockets are never profiled.
+
+# ---------- IMPORTS ----------
+
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Set
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0")) # 0 disables slow request capture
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005")) # seconds between CPU samples
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50")) # files kept per ring
+PROFILE_DIR = os.path.abspath(os.getenv("PROFILE_DIR", "profiles"))
+PROFILE_MAX_SQL = 500 # statements kept per request
+PROFILE_MAX_SQL_LEN = 2000
+
+log = logging.getLogger("carisma.profiling")
+
+_current: ContextVar[Optional["Profile"]] = ContextVar("profile", default=None)
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ---------- PROFILE ----------
+
+class Profile:
+    def __init__(self, scope: dict, cpu: bool, forced: bool):
+        self.id = uuid.uuid4().hex
+        self.scope = scope
+        self.cpu = cpu
+        self.forced = forced
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.duration_ms = 0.0
+        self.status_code = 0
+
+        self.sql: List[dict] = []
+        self.sql_count = 0
+        self.sql_ms = 0.0
+
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self._codes: Optional[Set] = None
+
+    def add_sql(self, statement: str, ms: float, executemany: bool) -> None:
+        self.sql_count += 1
+        self.sql_ms += ms
+        if len(self.sql) < PROFILE_MAX_SQL:
+            self.sql.append({
+                "statement": statement[:PROFILE_MAX_SQL_LEN],
+                "ms": round(ms, 3),
+                "executemany": executemany,
+            })
+
+    def _handler_codes(self) -> Optional[Set]:
+        # Code objects of the matched endpoint and its dependencies, known once routed
+        if self._codes is None:
+            route = self.scope.get("route")
+            dependant = getattr(route, "dependant", None)
+            if dependant is None:
+                return None
+            codes = set()
+            pending = [dependant]
+            while pending:
+                dep = pending.pop()
+                code = getattr(dep.call, "__code__", None)
+                if code is not None:
+                    codes.add(code)
+                pending.extend(dep.dependencies)
+            self._codes = codes
+        return self._codes
+
+    def sample(self, frames: Dict[int, object], sampler_id: int) -> None:
+        # A thread is ours while one of our handler's frames is on its stack. Two
+        # concurrent requests to the same endpoint can't be told apart, good enough.
+        codes = self._handler_codes()
+        if not codes:
+            return
+        self.samples += 1
+        for thread_id, frame in frames.items():
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            ours = False
+            while frame is not None:
+                code = frame.f_code
+                ours = ours or code in codes
+                stack.append("{}:{}".format(_short(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if ours:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.scope.get("method"),
+            "path": self.scope.get("path"),
+            "status_code": self.status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration_ms, 3),
+            "forced": self.forced,
+            "sql_count": self.sql_count,
+            "sql_ms": round(self.sql_ms, 3),
+            "sql": self.sql,
+            "cpu": {
+                "interval_ms": PROFILE_INTERVAL * 1000,
+                "samples": self.samples,
+                "stacks": dict(self.stacks.most_common()),
+            } if self.cpu else None,
+        }
+
+def _short(filename: str) -> str:
+    # App files relative to the app, libraries from site-packages on
+    if filename.startswith(_APP_DIR):
+        return os.path.relpath(filename, _APP_DIR)
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+# ---------- CPU SAMPLER ----------
+# One thread per process, running only while some profile is active
+
+class _Sampler:
+    def __init__(self):
+        self._active: Set[Profile] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: Profile) -> None:
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: Profile) -> None:
+        with self._lock:
+            self._active.discard(profile)
+
+    def _run(self) -> None:
+        sampler_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active)
+            frames = sys._current_frames()
+            for profile in active:
+                profile.sample(frames, sampler_id)
+            del frames
+            time.sleep(PROFILE_INTERVAL)
+
+_sampler = _Sampler()
+
+# ---------- SQL ----------
+
+def instrument(engine) -> None:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context._profiling_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    start = getattr(context, "_profiling_start", None)
+    if profile is not None and start is not None:
+        profile.add_sql(statement, (time.perf_counter() - start) * 1000, executemany)
+
+# ---------- STORAGE ----------
+# slow_<duration>_<id>.json keeps the slowest, req_<time>_<id>.json the latest forced
+
+def _evict(prefix: str) -> None:
+    files = sorted(glob.glob(os.path.join(PROFILE_DIR, prefix + "_*.json")))
+    for path in files[:-PROFILE_KEEP] if len(files) > PROFILE_KEEP else []:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # another worker got there first
+
+def save(profile: Profile) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if profile.forced:
+        prefix, key = "req", time.time_ns()
+    else:
+        prefix, key = "slow", int(profile.duration_ms * 1000)
+    path = os.path.join(PROFILE_DIR, "{}_{:020d}_{}.json".format(prefix, key, profile.id))
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(profile.to_dict(), f)
+    os.replace(tmp, path)
+    _evict(prefix)
+
+def list_profiles() -> List[dict]:
+    profiles = []
+    for path in glob.glob(os.path.join(PROFILE_DIR, "*_*_*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue # evicted or half written meanwhile
+        data.pop("sql", None)
+        cpu = data.pop("cpu", None)
+        data["cpu_samples"] = cpu["samples"] if cpu else None
+        profiles.append(data)
+    return sorted(profiles, key=lambda p: p["duration_ms"], reverse=True)
+
+def profile_path(profile_id: str) -> Optional[str]:
+    if not profile_id.isalnum():
+        return None
+    paths = glob.glob(os.path.join(PROFILE_DIR, "*_*_{}.json".format(profile_id)))
+    return paths[0] if paths else None
+
+# ---------- MIDDLEWARE ----------
+
+def begin(scope: dict, forced: bool) -> Optional[Profile]:
+    if forced or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        profile = Profile(scope, cpu=True, forced=forced)
+        _sampler.add(profile)
+    elif PROFILE_SLOW_MS:
+        profile = Profile(scope, cpu=False, forced=False)
+    else:
+        return None
+    _current.set(profile)
+    return profile
+
+def end(profile: Profile, status_code: int) -> bool:
+    """Stop profiling, returns True when the profile is worth saving."""
+    profile.duration_ms = (time.perf_counter() - profile.start) * 1000
+    profile.status_code = status_code
+    _current.set(None)
+    if profile.cpu:
+        _sampler.remove(profile)
+        return True
+    return profile.duration_ms >= PROFILE_SLOW_MS
+
+def discard(profile: Profile) -> None:
+    _current.set(None)
+    if profile.cpu:
+        _sampler.remove(profile)
+
+# Streams last as long as the client stays, their duration says nothing
+STREAMING_TYPES = (b"text/event-stream", b"application/x-ndjson")
+
+class ProfilingMiddleware:
+    """Pure ASGI, so a profile covers the whole response body, not just the headers.
+
+    `is_forced(header)` gets the X-Profile header and says whether it is valid.
+    """
+
+    def __init__(self, app, is_forced: Callable[[Optional[str]], bool]):
+        self.app = app
+        self.is_forced = is_forced
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        header = dict(scope["headers"]).get(b"x-profile")
+        profile = begin(scope, self.is_forced(header.decode("latin-1") if header else None))
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        state = {"status_code": 500, "active": True}
+
+        async def finish() -> None:
+            state["active"] = False
+            if end(profile, state["status_code"]):
+                try:
+                    await run_in_threadpool(save, profile)
+                except OSError:
+                    log.exception("could not save profile %s", profile.id)
+
+        async def send_wrapper(message) -> None:
+            if message["type"] == "http.response.start":
+                state["status_code"] = message["status"]
+                content_type = dict(message.get("headers", ())).get(b"content-type", b"")
+                if content_type.startswith(STREAMING_TYPES):
+                    state["active"] = False
+                    discard(profile)
+                elif profile.forced:
+                    message["headers"] = list(message.get("headers", ())) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and state["active"]:
+                await finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if state["active"]: # raised, or returned without a complete response
+                await finish()
@@ -0,0 +1,302 @@
+# realtime.py
+
+# Live vote/comment updates for open screens, so the client stops polling GET /posts/{id}.
+#
+# Clients subscribe to topics ("post:12", "community:3") over the WebSocket or the SSE
+# endpoint. Endpoints publish with `hub.publish_counts(...)` / `hub.publish_comment(...)`
+# (safe to call from the sync handlers' threads). Count deltas are summed per post for
+# REALTIME_WINDOW seconds before they leave the process, and summed again per connection
+# while it is busy sending, so a viral post costs one message per window, not per vote.
+#
+# Every subscription remembers the community it belongs to, and `hub.revoke(...)` drops
+# the ones a user may no longer see (banned, left a private community, deleted).
+#
+# Every worker has its own hub. With more than one worker set REALTIME_BACKEND_URL to a
+# redis:// url (needs the `redis` package) so events published in one reach all of them.
+
+# ---------- IMPORTS ----------
+
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set
+import asyncio
+import json
+import logging
+import os
+
+REALTIME_BACKEND_URL = os.getenv("REALTIME_BACKEND_URL") # unset: in-process only
+REALTIME_WINDOW = float(os.getenv("REALTIME_WINDOW", "0.25")) # seconds deltas are coalesced for
+REALTIME_MAX_PENDING = int(os.getenv("REALTIME_MAX_PENDING", "256")) # per connection, then it gets a "resync"
+REALTIME_MAX_TOPICS = int(os.getenv("REALTIME_MAX_TOPICS", "200")) # per connection
+REALTIME_RECONNECT_MAX = 30.0 # seconds, cap of the backoff after losing the backend
+
+log = logging.getLogger("carisma.realtime")
+
+def post_topic(post_id: int) -> str:
+    return "post:{}".format(post_id)
+
+def community_topic(community_id: int) -> str:
+    return "community:{}".format(community_id)
+
+# ---------- BACKENDS ----------
+# A backend moves (topics, event) pairs between workers and calls `deliver` on each.
+
+class LocalBackend:
+    async def start(self, deliver: Callable[[List[str], dict], None]) -> None:
+        self.deliver = deliver
+
+    async def publish(self, topics: List[str], event: dict) -> None:
+        self.deliver(topics, event)
+
+    async def stop(self) -> None:
+        pass
+
+class RedisBackend:
+    channel = "carisma:realtime"
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("REALTIME_BACKEND_URL is set but the `redis` package is not installed")
+        self.redis = redis.from_url(url)
+        self.pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Callable[[List[str], dict], None]) -> None:
+        self.deliver = deliver
+        await self._subscribe()
+        self._task = asyncio.create_task(self._listen())
+
+    async def _subscribe(self) -> None:
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(self.channel)
+
+    async def _listen(self) -> None:
+        # Reconnects with backoff: events published meanwhile are lost, the permissions
+        # reload and the vote cache TTL catch up on those
+        delay = 1.0
+        while True:
+            try:
+                if self.pubsub is None:
+                    await self._subscribe()
+                    log.info("realtime backend reconnected")
+                async for message in self.pubsub.listen():
+                    delay = 1.0
+                    try:
+                        data = json.loads(message["data"])
+                        self.deliver(data["topics"], data["event"])
+                    except Exception:
+                        log.exception("bad realtime message")
+            except Exception:
+                log.exception("realtime backend connection lost, retrying in %ss", delay)
+                if self.pubsub is not None:
+                    try:
+                        await self.pubsub.aclose()
+                    except Exception:
+                        pass
+                    self.pubsub = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, REALTIME_RECONNECT_MAX)
+
+    async def publish(self, topics: List[str], event: dict) -> None:
+        await self.redis.publish(self.channel, json.dumps({"topics": topics, "event": event}, default=str))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.unsubscribe(self.channel)
+        await self.redis.aclose()
+
+def make_backend():
+    if REALTIME_BACKEND_URL:
+        return RedisBackend(REALTIME_BACKEND_URL)
+    return LocalBackend()
+
+# ---------- CONNECTIONS ----------
+
+class Connection:
+    """Outgoing buffer of one client.
+
+    Count deltas are merged per post while the client is busy; other events are
+    queued. When the client falls too far behind the oldest events are dropped and
+    it gets a single {"type": "resync"} telling it to re-fetch.
+    """
+
+    def __init__(self, user_id: Optional[int] = None, max_pending: int = REALTIME_MAX_PENDING):
+        self.user_id = user_id
+        self.topics: Dict[str, int] = {} # topic -> community it belongs to
+        self.max_pending = max_pending
+        self._counts: Dict[int, dict] = {}
+        self._events: Deque[dict] = deque()
+        self._overflowed = False
+        self._wakeup = asyncio.Event()
+
+    def push(self, event: dict) -> None:
+        if event["type"] == "counts":
+            pending = self._counts.get(event["post_id"])
+            if pending:
+                for key in ("likes", "dislikes", "comments"):
+                    pending[key] += event[key]
+            elif len(self._counts) >= self.max_pending:
+                self._overflowed = True
+            else:
+                self._counts[event["post_id"]] = dict(event)
+        else:
+            if len(self._events) >= self.max_pending:
+                self._events.popleft()
+                self._overflowed = True
+            self._events.append(event)
+        self._wakeup.set()
+
+    async def next_batch(self, window: float = REALTIME_WINDOW) -> List[dict]:
+        await self._wakeup.wait()
+        await asyncio.sleep(window) # let more deltas pile up on hot posts
+        self._wakeup.clear()
+
+        batch: List[dict] = []
+        if self._overflowed:
+            batch.append({"type": "resync"})
+        batch.extend(self._events)
+        batch.extend(self._counts.values())
+
+        self._events.clear()
+        self._counts = {}
+        self._overflowed = False
+        return batch
+
+# ---------- HUB ----------
+
+class Hub:
+    def __init__(self):
+        self.backend = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Dict[str, Set[Connection]] = {}
+        self._communities: Dict[int, Set[Connection]] = {}
+        self._listeners: Dict[str, List[Callable[[dict], None]]] = {}
+        self._outgoing: Dict[int, dict] = {}
+        self._flush_scheduled = False
+
+    async def start(self) -> None:
+        # Called from the lifespan, so the loop and backend belong to this worker
+        self.loop = asyncio.get_running_loop()
+        self.backend = make_backend()
+        await self.backend.start(self._deliver)
+
+    async def stop(self) -> None:
+        if self.backend:
+            await self.backend.stop()
+        self.loop = None
+
+    # ---- Subscriptions ----
+
+    def subscribe(self, conn: Connection, topics: Dict[str, int]) -> None:
+        # topics: topic -> id of the community it belongs to
+        for topic, community_id in topics.items():
+            if len(conn.topics) >= REALTIME_MAX_TOPICS:
+                break
+            conn.topics[topic] = community_id
+            self._subscribers.setdefault(topic, set()).add(conn)
+            self._communities.setdefault(community_id, set()).add(conn)
+
+    def unsubscribe(self, conn: Connection, topics: Iterable[str]) -> None:
+        left = set()
+        for topic in topics:
+            community_id = conn.topics.pop(topic, None)
+            if community_id is None:
+                continue
+            left.add(community_id)
+            subscribers = self._subscribers.get(topic)
+            if subscribers:
+                subscribers.discard(conn)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+        for community_id in left - set(conn.topics.values()):
+            connections = self._communities.get(community_id)
+            if connections:
+                connections.discard(conn)
+                if not connections:
+                    del self._communities[community_id]
+
+    def revoke(self, community_id: int, can_view: Callable[[int, Optional[int]], bool]) -> None:
+        # After a permission change (event loop): drop what its users may no longer see
+        for conn in list(self._communities.get(community_id, ())):
+            if not can_view(community_id, conn.user_id):
+                self.unsubscribe(conn, [t for t, c in conn.topics.items() if c == community_id])
+                conn.push({"type": "revoked", "community_id": community_id})
+
+    def drop(self, conn: Connection) -> None:
+        self.unsubscribe(conn, list(conn.topics))
+
+    def listen(self, topic: str, fn: Callable[[dict], None]) -> None:
+        # In-process consumers of internal topics (e.g. permission changes), not clients
+        self._listeners.setdefault(topic, []).append(fn)
+
+    def _deliver(self, topics: List[str], event: dict) -> None:
+        # A connection subscribed to both the post and its community gets it once
+        targets: Set[Connection] = set()
+        for topic in topics:
+            targets.update(self._subscribers.get(topic, ()))
+            for fn in self._listeners.get(topic, ()):
+                try:
+                    fn(event)
+                except Exception:
+                    log.exception("listener for %s failed", topic)
+        for conn in targets:
+            conn.push(event)
+
+    # ---- Publishing (any thread) ----
+
+    def _call(self, fn, *args) -> None:
+        loop = self.loop
+        if loop is None:
+            return # not started (CLI, jobs worker): nobody is listening here
+        loop.call_soon_threadsafe(fn, *args)
+
+    def publish(self, topics: List[str], event: dict) -> None:
+        self._call(self._publish, topics, event)
+
+    def publish_counts(self, post_id: int, community_id: int, likes: int = 0, dislikes: int = 0, comments: int = 0) -> None:
+        self._call(self._add_counts, post_id, community_id, likes, dislikes, comments)
+
+    def publish_comment(self, post_id: int, community_id: int, comment: dict) -> None:
+        event = {"type": "comment", "post_id": post_id, "community_id": community_id, "comment": comment}
+        self.publish([post_topic(post_id), community_topic(community_id)], event)
+
+    # ---- Publishing (event loop) ----
+
+    def _publish(self, topics: List[str], event: dict) -> None:
+        self.loop.create_task(self.backend.publish(topics, event))
+
+    def _add_counts(self, post_id: int, community_id: int, likes: int, dislikes: int, comments: int) -> None:
+        pending = self._outgoing.get(post_id)
+        if pending is None:
+            pending = self._outgoing[post_id] = {
+                "type": "counts",
+                "post_id": post_id,
+                "community_id": community_id,
+                "likes": 0,
+                "dislikes": 0,
+                "comments": 0,
+            }
+        pending["likes"] += likes
+        pending["dislikes"] += dislikes
+        pending["comments"] += comments
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_later(REALTIME_WINDOW, self._flush_counts)
+
+    def _flush_counts(self) -> None:
+        self._flush_scheduled = False
+        outgoing, self._outgoing = self._outgoing, {}
+        for event in outgoing.values():
+            if event["likes"] or event["dislikes"] or event["comments"]:
+                self._publish([post_topic(event["post_id"]), community_topic(event["community_id"])], event)
+
+hub = Hub()
+
+def parse_topics(posts: Iterable[int] = (), communities: Iterable[int] = ()) -> List[str]:
+    # Topic names only, e.g. to unsubscribe
+    return [post_topic(int(p)) for p in posts] + [community_topic(int(c)) for c in communities]
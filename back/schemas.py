@@ -1,10 +1,11 @@
 # schemas.py
 
-from pydantic import BaseModel, Field, EmailStr, field_validator
-from typing import Optional
-from datetime import datetime
+from pydantic import BaseModel, Field, EmailStr, computed_field, field_validator
+from typing import Optional, Dict, Literal
+from datetime import datetime, timezone
 
-from models import UserStatus, CommunityType
+from models import UserStatus, CommunityType, CommunityRole
+from media import thumbnail_urls
 
 # ---- Payloads ----
 
@@ -15,13 +16,27 @@ class PostCreatePayload(BaseModel):
     image_url: Optional[str] = Field(default=None, min_length=1)
 
 class PostThumbPayload(BaseModel):
-    value: int = Field(ge=-1, le=1)
+    value: int = Field(ge=-1, le=1) # 0 clears the vote
+
+class CommentCreatePayload(BaseModel):
+    body: str = Field(min_length=1)
+    parent_comment_id: Optional[int] = None
     
 class CommunityCreatePayload(BaseModel):
     name: str = Field(min_length=1, pattern=r".*\D.*")
     description: str | None = Field(default=None, min_length=1)
     type: CommunityType = CommunityType.PUBLIC
 
+class CommunityRolePayload(BaseModel):
+    role: CommunityRole
+
+    @field_validator("role")
+    @classmethod
+    def not_owner(cls, v: CommunityRole):
+        if v == CommunityRole.OWNER:
+            raise ValueError("ownership can't be granted")
+        return v
+
 class UserCreatePayload(BaseModel):
     username: str = Field(min_length=1, pattern=r"^[^@]+$")
     email: EmailStr = Field(max_length=254)
@@ -45,6 +60,11 @@ class UserBaseOut(BaseModel):
     username: str
     image_url: Optional[str] = None
 
+    @computed_field
+    @property
+    def thumbnails(self) -> Dict[str, str]: # size -> url, empty for external images
+        return thumbnail_urls(self.image_url)
+
 class UserPublicOut(UserBaseOut):
     created_at: datetime
     status: UserStatus
@@ -67,6 +87,13 @@ class CommunityPublicOut(CommunityBaseOut):
     personal_user_id: int | None = None
     created_at: datetime
     
+class CommunityRoleOut(BaseModel):
+    community_id: int
+    user_id: int
+    role: CommunityRole
+    granted_by_user_id: int | None = None
+    created_at: datetime
+
 class PostOut(BaseModel):
     id: int
     community: CommunityBaseOut
@@ -78,13 +105,69 @@ class PostOut(BaseModel):
     likes: int
     dislikes: int
     comments: int
+    my_vote: Optional[int] = None # -1 / 0 / 1 for the current user, None when anonymous
+
+    @computed_field
+    @property
+    def thumbnails(self) -> Dict[str, str]:
+        return thumbnail_urls(self.image_url)
+
+class CommentOut(BaseModel):
+    id: int
+    post_id: int
+    parent_comment_id: Optional[int] = None
+    author: UserBaseOut
+    body: str
+    created_at: datetime
+
+# ---- Bulk Records ----
+# One NDJSON line each, tagged with "type" (see bulk.py)
+
+class CommunityRecord(BaseModel):
+    id: Optional[int] = None
+    name: str = Field(min_length=1, pattern=r".*\D.*")
+    description: Optional[str] = None
+    type: CommunityType = CommunityType.PUBLIC
+    image_url: Optional[str] = None
+    owner_user_id: int
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    deleted_at: Optional[datetime] = None
+
+class PostRecord(BaseModel):
+    id: Optional[int] = None
+    community_id: int
+    author_user_id: int
+    title: str = Field(min_length=1)
+    body: Optional[str] = None
+    image_url: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    edited_at: Optional[datetime] = None
+    deleted_at: Optional[datetime] = None
+
+class VoteRecord(BaseModel):
+    post_id: int
+    user_id: int
+    value: Literal[-1, 1]
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # ---- Responses ----
 
 class PostCreateResponse(BaseModel):
     id: int
 
+class MediaOut(BaseModel):
+    url: str
+    thumbnails: Dict[str, str]
+    size: int
+    deduplicated: bool
+
 class LoginResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
     user: UserPrivateOut
+
+class BulkImportResponse(BaseModel):
+    lines: int
+    checkpoint: int # last line committed, pass it as resume_from to continue
+    written: Dict[str, int]
+    skipped: Dict[str, int] # already stored identically (replayed lines)
@@ -0,0 +1,34 @@
+# test_bulk.py
+
+# Export -> import round trip on SQLite, no MySQL needed:  pytest test_bulk.py
+
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from bulk import Importer, export_ndjson
+from models import Community, CommunityType
+
+def _engine():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+def test_round_trip_keeps_community_types():
+    source = _engine()
+    with Session(source) as session:
+        for i, community_type in enumerate(CommunityType, start=1):
+            session.add(Community(id=i, name="c{}".format(community_type.value), type=community_type, owner_user_id=1))
+        session.commit()
+
+    lines = list(export_ndjson(source, ["community"]))
+    assert len(lines) == len(CommunityType)
+
+    target = _engine()
+    with Session(target) as session:
+        importer = Importer(session, batch_size=100)
+        for line in lines:
+            importer.feed(line)
+        importer.flush()
+        assert importer.result()["written"]["community"] == len(CommunityType)
+
+        imported = {c.id: c.type for c in session.exec(select(Community))}
+    assert imported == {i: t for i, t in enumerate(CommunityType, start=1)}
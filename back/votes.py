@@ -0,0 +1,119 @@
+# votes.py
+
+# Small per-process cache of the votes of recently active users, so rendering
+# `my_vote` on a feed page usually needs no query at all.
+#
+# Entries are {post_id: value} per user (0 = known "no vote"), filled by the bulk
+# post_votes lookup and written through by the vote endpoint. Other workers learn
+# about a vote through the realtime backend, so the cache is only on by default with
+# REALTIME_BACKEND_URL set or a single worker (WEB_CONCURRENCY=1). VOTE_CACHE_TTL
+# bounds anything missed (e.g. bulk imports).
+#
+# A lookup runs between get_many and put_many; a vote set meanwhile wins over it.
+
+# ---------- IMPORTS ----------
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+import os
+import threading
+import time
+
+import realtime
+
+_SHARED = bool(realtime.REALTIME_BACKEND_URL) or os.getenv("WEB_CONCURRENCY") == "1"
+VOTE_CACHE_USERS = int(os.getenv("VOTE_CACHE_USERS", "10000" if _SHARED else "0")) # 0 disables the cache
+VOTE_CACHE_POSTS = int(os.getenv("VOTE_CACHE_POSTS", "500")) # per user
+VOTE_CACHE_TTL = float(os.getenv("VOTE_CACHE_TTL", "60")) # seconds
+TOPIC = "internal:votes"
+
+# ---------- CACHE ----------
+
+class RecentVotes:
+    def __init__(self, max_users: int = VOTE_CACHE_USERS, max_posts: int = VOTE_CACHE_POSTS, ttl: float = VOTE_CACHE_TTL):
+        self.max_users = max_users
+        self.max_posts = max_posts
+        self.ttl = ttl
+        # user -> (created, {post: value}, {post: version of the last set})
+        self._users: "OrderedDict[int, Tuple[float, Dict[int, int], Dict[int, int]]]" = OrderedDict()
+        self._version = 0 # bumped by every set
+        self._lock = threading.Lock() # handlers run on the threadpool
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0
+
+    def _entry(self, user_id: int, create: bool):
+        entry = self._users.get(user_id)
+        now = time.monotonic()
+        if entry is not None and now - entry[0] > self.ttl:
+            del self._users[user_id]
+            entry = None
+        if entry is None and create:
+            entry = self._users[user_id] = (now, {}, {})
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        if entry is not None:
+            self._users.move_to_end(user_id)
+        return entry
+
+    def get_many(self, user_id: int, post_ids: Iterable[int]) -> Tuple[Dict[int, int], List[int], int]:
+        """Returns (known votes, post ids that still have to be looked up, version).
+
+        Look the missing ones up after this call and hand the version to put_many.
+        """
+        post_ids = list(post_ids)
+        if not self.max_users:
+            return {}, post_ids, 0
+        with self._lock:
+            entry = self._entry(user_id, create=False)
+            if entry is None:
+                return {}, post_ids, self._version
+            known = entry[1]
+            return (
+                {p: known[p] for p in post_ids if p in known},
+                [p for p in post_ids if p not in known],
+                self._version,
+            )
+
+    def put_many(self, user_id: int, values: Dict[int, int], version: int) -> None:
+        if not self.max_users:
+            return
+        with self._lock:
+            _, known, set_at = self._entry(user_id, create=True)
+            for post_id, value in values.items():
+                if set_at.get(post_id, 0) <= version: # not voted since the lookup started
+                    known[post_id] = value
+            while len(known) > self.max_posts:
+                post_id = next(iter(known)) # oldest first
+                del known[post_id]
+                set_at.pop(post_id, None)
+
+    def set(self, user_id: int, post_id: int, value: int) -> None:
+        if not self.max_users:
+            return
+        with self._lock:
+            # Cached from now on, so a lookup already running can't put back the old vote
+            self._version += 1
+            _, known, set_at = self._entry(user_id, create=True)
+            known.pop(post_id, None)
+            known[post_id] = value # newest
+            set_at[post_id] = self._version
+            while len(known) > self.max_posts:
+                oldest = next(iter(known))
+                del known[oldest]
+                set_at.pop(oldest, None)
+
+    def apply(self, event: dict) -> None:
+        self.set(event["user_id"], event["post_id"], event["value"])
+
+cache = RecentVotes()
+
+def vote_changed(user_id: int, post_id: int, value: int) -> None:
+    # Call after the commit
+    event = {"user_id": user_id, "post_id": post_id, "value": value}
+    cache.apply(event)
+    realtime.hub.publish([TOPIC], event)
+
+def start() -> None:
+    realtime.hub.listen(TOPIC, cache.apply)